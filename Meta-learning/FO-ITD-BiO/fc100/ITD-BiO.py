@@ -34,8 +34,7 @@ class Lambda(nn.Module):
 
 
 def accuracy(predictions, targets):
-    predictions = predictions.argmax(dim=1).view(targets.shape)
-    return (predictions == targets).sum().float() / targets.size(0)
+    return (predictions.argmax(dim=1) == targets).float().mean()
 
 def task_adapt(loss, model, lr):
     try:
@@ -197,7 +196,7 @@ def main(
     start_time = time.time()
 
     for iteration in range(iters):
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         meta_train_error = 0.0
         meta_train_accuracy = 0.0
         meta_valid_error = 0.0
@@ -267,8 +266,8 @@ def main(
         print('Meta Test Accuracy', meta_test_accuracy / meta_bsz)
 
         # Average the accumulated gradients and optimize
-        for p in all_parameters:
-            p.grad.data.mul_(1.0 / meta_bsz)
+        grads = [p.grad for p in all_parameters if p.grad is not None]
+        torch._foreach_mul_(grads, 1.0 / meta_bsz)
         
         optimizer.step()
         end_time = time.time()
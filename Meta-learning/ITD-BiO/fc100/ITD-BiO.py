@@ -11,7 +11,9 @@ import matplotlib
 matplotlib.use('pdf')
 import matplotlib.pyplot as plt
 import torch
+import torch.distributed as dist
 from torch import nn
+from torch.func import functional_call, grad, jvp, vmap, replace_all_batch_norm_modules_
 import torchvision as tv
 
 import learn2learn as l2l
@@ -19,6 +21,7 @@ from learn2learn.data.transforms import FusedNWaysKShots, LoadData, RemapLabels,
 
 from statistics import mean
 from copy import deepcopy
+from functools import partial
 
 import pickle
 
@@ -33,57 +36,171 @@ class Lambda(nn.Module):
 
 
 def accuracy(predictions, targets):
-    predictions = predictions.argmax(dim=1).view(targets.shape)
-    return (predictions == targets).sum().float() / targets.size(0)
+    return (predictions.argmax(dim=1) == targets).float().mean()
+
+
+def conjugate_gradient(Ax, b, steps, eps=1e-12):
+    # Solves Ax = b for a dict of tensors with a fixed number of iterations,
+    # so that it can run under vmap without data-dependent stopping. The
+    # denominators are clamped to eps: once a task has converged its residual
+    # is zero, and 0/0 would spread NaN to the whole meta-batch gradient.
+    x = {name: torch.zeros_like(v) for name, v in b.items()}
+    r = dict(b)
+    p = dict(b)
+    rTr = sum((v * v).sum() for v in r.values())
+    for _ in range(steps):
+        Ap = Ax(p)
+        alpha = rTr / torch.clamp(sum((p[name] * Ap[name]).sum() for name in p), min=eps)
+        x = {name: x[name] + alpha * p[name] for name in x}
+        r = {name: r[name] - alpha * Ap[name] for name in r}
+        new_rTr = sum((v * v).sum() for v in r.values())
+        beta = new_rTr / torch.clamp(rTr, min=eps)
+        p = {name: r[name] + beta * p[name] for name in p}
+        rTr = new_rTr
+    return x
+
+
+def inner_loop(params,
+               adaptation_data,
+               adaptation_labels,
+               evaluation_data,
+               evaluation_labels,
+               head,
+               loss,
+               reg_lambda,
+               adaptation_steps,
+               fast_lr,
+               first_order=False,
+               implicit=False,
+               cg_steps=5,
+               cg_damping=1.0):
+    # Adapts the head to a single task; vmapped over the meta-batch in fast_adapt.
+    def train_loss(params, adaptation_data):
+        l2_reg = sum((p * p).sum() for p in params.values())
+        predictions = functional_call(head, params, (adaptation_data,))
+        return loss(predictions, adaptation_labels) + reg_lambda*l2_reg
+
+    def eval_loss(params, evaluation_data):
+        predictions = functional_call(head, params, (evaluation_data,))
+        return loss(predictions, evaluation_labels)
+
+    # With first_order or implicit, the inner updates are not differentiated
+    # through, so no graph is kept across the adaptation steps.
+    for step in range(adaptation_steps):
+        grads = grad(train_loss)(params, adaptation_data)
+        if first_order or implicit:
+            grads = {name: g.detach() for name, g in grads.items()}
+        params = {name: p - fast_lr * grads[name] for name, p in params.items()}
+
+    predictions = functional_call(head, params, (evaluation_data,))
+    valid_error = loss(predictions, evaluation_labels)
+    valid_accuracy = accuracy(predictions, evaluation_labels)
+
+    if implicit:
+        # Implicit hypergradient: solve (H + cg_damping*I) v = dL_val/dw with H the Hessian
+        # of the inner loss at the adapted head, then the features receive the extra term
+        # -d<dL_train/dw, v>/d(features). The value of valid_error is left unchanged.
+        params = {name: p.detach() for name, p in params.items()}
+        valid_grads = grad(eval_loss)(params, evaluation_data.detach())
+
+        def damped_hvp(v):
+            train_grad = partial(grad(train_loss), adaptation_data=adaptation_data.detach())
+            _, hvp = jvp(train_grad, (params,), (v,))
+            return {name: hvp[name] + cg_damping * v[name] for name in v}
+
+        v = conjugate_gradient(damped_hvp, valid_grads, cg_steps)
+        train_grads = grad(train_loss)(params, adaptation_data)
+        correction = sum((train_grads[name] * v[name]).sum() for name in v)
+        valid_error = valid_error - correction + correction.detach()
+
+    return valid_error, valid_accuracy
 
 
 def fast_adapt(batch,
-               learner,
+               params,
+               head,
                features,
                loss,
                reg_lambda,
                adaptation_steps,
-               shots,
-               ways,
-               device=None):
-
+               fast_lr,
+               adaptation_indices,
+               evaluation_indices,
+               device=None,
+               amp=False,
+               **kwargs):
+
+    # batch holds a stack of tasks: [meta_bsz, 2*shots*ways, ...], which
+    # features embeds as a whole (see embed_tasks)
     data, labels = batch
-    data, labels = data.to(device), labels.to(device)
-    data = features(data)
+    data, labels = data.to(device, non_blocking=True), labels.to(device, non_blocking=True)
 
-    # Separate data into adaptation/evaluation sets
-    adaptation_indices = np.zeros(data.size(0), dtype=bool)
-    adaptation_indices[np.arange(shots*ways) * 2] = True
-    evaluation_indices = torch.from_numpy(~adaptation_indices)
-    adaptation_indices = torch.from_numpy(adaptation_indices)
-    adaptation_data, adaptation_labels = data[adaptation_indices], labels[adaptation_indices]
-    evaluation_data, evaluation_labels = data[evaluation_indices], labels[evaluation_indices]
+    # With amp, embed in bfloat16 on GPU: no loss scaling is needed and parameters stay in
+    # float32. The head adaptation, including the implicit Hessian-vector products and
+    # conjugate gradient solve, runs in float32.
+    with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=amp and device.type == 'cuda'):
+        data = features(channels_last(data))
+    data = data.float()
 
-    for step in range(adaptation_steps):
-        l2_reg = 0
-        for p in learner.parameters():
-            l2_reg += p.norm(2)
-        train_error = loss(learner(adaptation_data), adaptation_labels) + reg_lambda*l2_reg 
-        learner.adapt(train_error)
+    # Separate data into adaptation/evaluation sets
+    adaptation_data, adaptation_labels = data.index_select(1, adaptation_indices), labels.index_select(1, adaptation_indices)
+    evaluation_data, evaluation_labels = data.index_select(1, evaluation_indices), labels.index_select(1, evaluation_indices)
+
+    # Returns the per-task evaluation error and accuracy
+    return vmap(inner_loop, in_dims=(None, 0, 0, 0, 0))(params,
+                                                        adaptation_data,
+                                                        adaptation_labels,
+                                                        evaluation_data,
+                                                        evaluation_labels,
+                                                        head=head,
+                                                        loss=loss,
+                                                        reg_lambda=reg_lambda,
+                                                        adaptation_steps=adaptation_steps,
+                                                        fast_lr=fast_lr,
+                                                        **kwargs)
+
+
+def task_loader(tasks, num_tasks, num_workers, device, seed):
+    # Returns an endless iterator over meta-batches of num_tasks randomly drawn tasks,
+    # which background workers sample, stack and pin.
+    # TaskDataset draws a task description the first time an index is requested. Draw
+    # them all here, so that every worker shares the same fixed pool of len(tasks) tasks
+    # instead of filling its own differently seeded copy.
+    for i in range(len(tasks)):
+        if i not in tasks.sampled_descriptions:
+            tasks.sampled_descriptions[i] = tasks.sample_task_description()
+    loader = torch.utils.data.DataLoader(tasks,
+                                         batch_size=num_tasks,
+                                         shuffle=True,
+                                         drop_last=True,
+                                         generator=torch.Generator().manual_seed(seed),
+                                         num_workers=num_workers,
+                                         pin_memory=device.type == 'cuda',
+                                         persistent_workers=num_workers > 0,
+                                         prefetch_factor=2 if num_workers > 0 else None)
+
+    # The workers start here, not at the first next(), so that setup is not timed
+    def endless(iterator):
+        while True:
+            yield from iterator
+            iterator = iter(loader)
+    return endless(iter(loader))
+
+
+def channels_last(data):
+    # Lays out a stack of tasks [meta_batch, samples, C, H, W] so that the batch of
+    # images seen by the vmapped convolutions is channels_last (NHWC) for cuDNN
+    return data.flatten(0, 1).contiguous(memory_format=torch.channels_last).view(data.shape)
+
+
+def all_reduce_sum(values):
+    # Sums a list of 0-dim tensors over the processes of a torchrun launch
+    if not dist.is_initialized():
+        return values
+    values = torch.stack(values)
+    dist.all_reduce(values)
+    return values.unbind()
 
-    predictions = learner(evaluation_data)
-    valid_error = loss(predictions, evaluation_labels)
-    valid_accuracy = accuracy(predictions, evaluation_labels)
-    
-    # weightnorms = 0  ## check whether d(y_N)/dx is computed or not.
-    # for p in learner.parameters():
-    #     weightnorms += p.norm()
-    
-    # weightnorms.backward()
-    
-    # for i in features.parameters():
-    #     print (i.grad)
-    
-    # for i in learner.parameters():
-    #     print (i.grad)
-        
-    
-    return valid_error, valid_accuracy
 
 def main(
         ways=5,
@@ -94,21 +211,43 @@ def main(
         adapt_steps=5, # original: 5
         meta_bsz=32,
         iters=1000, # orginal: 1000
+        first_order=False,
+        implicit=False,
+        cg_steps=5,
+        cg_damping=1.0,
+        compile_features=False,
         cuda=1,
+        eval_every=20,
+        amp=False,
+        num_workers=4,
         seed=42,
 ):
     
     # print('hlr='+str(meta_head_lr)+' flr='+str(fast_lr)+' reg='+str(reg_lambda))
     
     cuda = bool(cuda)
-
-    random.seed(seed)
-    np.random.seed(seed)
+    if first_order and implicit:
+        raise ValueError('first_order and implicit select different hypergradients, set at most one')
+
+    # Under torchrun, every process adapts meta_bsz // world_size tasks
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    rank = int(os.environ.get('RANK', 0))
+    if meta_bsz % world_size != 0:
+        raise ValueError('meta_bsz (%d) must be divisible by the number of processes (%d)'
+                         % (meta_bsz, world_size))
+    tasks_per_rank = meta_bsz // world_size
+
+    # Tasks differ across processes, the initial model does not
+    random.seed(seed + rank)
+    np.random.seed(seed + rank)
     torch.manual_seed(seed)
     device = torch.device('cpu')
     if cuda and torch.cuda.device_count():
         torch.cuda.manual_seed(seed)
-        device = torch.device('cuda')
+        device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+        torch.cuda.set_device(device)
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group('nccl' if device.type == 'cuda' else 'gloo')
 
     # Create Datasets
     train_dataset = l2l.vision.datasets.FC100(root='~/data',
@@ -153,15 +292,33 @@ def main(
     test_tasks = l2l.data.TaskDataset(test_dataset,
                                       task_transforms=test_transforms,
                                       num_tasks=600)
+    train_tasks = task_loader(train_tasks, tasks_per_rank, num_workers, device, seed + rank)
+    valid_tasks = task_loader(valid_tasks, tasks_per_rank, num_workers, device, seed + rank)
+    test_tasks = task_loader(test_tasks, tasks_per_rank, num_workers, device, seed + rank)
 
 
     # Create model
     features = l2l.vision.models.ConvBase(output_size=64, channels=3, max_pool=True)
-    features = torch.nn.Sequential(features, Lambda(lambda x: x.view(-1, 256)))
-    features.to(device)
+    features = torch.nn.Sequential(features, Lambda(lambda x: x.reshape(-1, 256)))
+    # Running statistics are never used and cannot be updated under vmap
+    replace_all_batch_norm_modules_(features)
+    features.to(device, memory_format=torch.channels_last)
     head = torch.nn.Linear(256, ways)
-    head = l2l.algorithms.MAML(head, lr=fast_lr)
     head.to(device)
+    # Every task adapts the same fixed initial head, which is never optimized:
+    # share its tensors across tasks and splits without recording gradients for them
+    head.requires_grad_(False)
+    head_params = dict(head.named_parameters())
+
+    # Embeds every task of a meta-batch separately, so BatchNorm keeps per-task statistics.
+    # Shapes are static, so the compiled version can be replayed with CUDA graphs.
+    embed_tasks = vmap(features)
+    if compile_features:
+        embed_tasks = torch.compile(embed_tasks, mode='reduce-overhead', dynamic=False)
+
+    # Even samples of each task are used for adaptation, odd ones for evaluation
+    adaptation_indices = torch.arange(0, 2*shots*ways, 2, device=device)
+    evaluation_indices = torch.arange(1, 2*shots*ways, 2, device=device)
     
     # Setup optimization
     all_parameters = list(features.parameters())
@@ -171,6 +328,10 @@ def main(
     
     ## use different learning rates for w and theta
     optimizer = torch.optim.Adam(all_parameters, lr=meta_lr)
+    if world_size > 1:
+        # cherry averages the gradients over processes before each step
+        import cherry
+        optimizer = cherry.optim.Distributed(all_parameters, opt=optimizer, sync=1)
     
     loss = nn.CrossEntropyLoss(reduction='mean')
     
@@ -180,79 +341,98 @@ def main(
     import time
     start_time = time.time()
 
+    # Validation and test metrics are only recomputed every eval_every iterations,
+    # all metrics stay on the device until they are printed
+    meta_valid_error = torch.zeros((), device=device)
+    meta_valid_accuracy = torch.zeros((), device=device)
+    meta_test_error = torch.zeros((), device=device)
+    meta_test_accuracy = torch.zeros((), device=device)
+
     for iteration in range(iters):
-        optimizer.zero_grad()
-        meta_train_error = 0.0
-        meta_train_accuracy = 0.0
-        meta_valid_error = 0.0
-        meta_valid_accuracy = 0.0
-        meta_test_error = 0.0
-        meta_test_accuracy = 0.0
-        
-        for task in range(meta_bsz):
-            # Compute meta-training loss
-            learner = head.clone()
-            batch = train_tasks.sample()
-            evaluation_error, evaluation_accuracy = fast_adapt(batch,
-                                                               learner,
-                                                               features,
-                                                               loss,
-                                                               reg_lambda,
-                                                               adapt_steps,
-                                                               shots,
-                                                               ways,
-                                                               device)
-            evaluation_error.backward()
-            meta_train_error += evaluation_error.item()
-            meta_train_accuracy += evaluation_accuracy.item()
-
-            # Compute meta-validation loss
-            learner = head.clone()
-            batch = valid_tasks.sample()
-            evaluation_error, evaluation_accuracy = fast_adapt(batch,
-                                                               learner,
-                                                               features,
-                                                               loss,
-                                                               reg_lambda,
-                                                               adapt_steps,
-                                                               shots,
-                                                               ways,
-                                                               device)
-            meta_valid_error += evaluation_error.item()
-            meta_valid_accuracy += evaluation_accuracy.item()
-
-            # Compute meta-testing loss
-            learner = head.clone()
-            batch = test_tasks.sample()
-            evaluation_error, evaluation_accuracy = fast_adapt(batch,
-                                                               learner,
-                                                               features,
-                                                               loss,
-                                                               reg_lambda,
-                                                               adapt_steps,
-                                                               shots,
-                                                               ways,
-                                                               device)
-            meta_test_error += evaluation_error.item()
-            meta_test_accuracy += evaluation_accuracy.item()
+        optimizer.zero_grad(set_to_none=True)
         
-        training_accuracy[iteration] = meta_train_accuracy / meta_bsz
-        test_accuracy[iteration] = meta_test_accuracy / meta_bsz
+        # Compute meta-training loss
+        batch = next(train_tasks)
+        evaluation_error, evaluation_accuracy = fast_adapt(batch,
+                                                           head_params,
+                                                           head,
+                                                           embed_tasks,
+                                                           loss,
+                                                           reg_lambda,
+                                                           adapt_steps,
+                                                           fast_lr,
+                                                           adaptation_indices,
+                                                           evaluation_indices,
+                                                           device,
+                                                           amp=amp,
+                                                           first_order=first_order,
+                                                           implicit=implicit,
+                                                           cg_steps=cg_steps,
+                                                           cg_damping=cg_damping)
+        # A single backward of the averaged loss covers the whole meta-batch
+        evaluation_error.mean().backward()
+        meta_train_error = evaluation_error.detach().sum()
+        meta_train_accuracy = evaluation_accuracy.sum()
+        meta_train_error, meta_train_accuracy = all_reduce_sum([meta_train_error, meta_train_accuracy])
+
+        if iteration % eval_every == 0:
+            with torch.no_grad():
+                # Compute meta-validation loss
+                batch = next(valid_tasks)
+                evaluation_error, evaluation_accuracy = fast_adapt(batch,
+                                                                   head_params,
+                                                                   head,
+                                                                   embed_tasks,
+                                                                   loss,
+                                                                   reg_lambda,
+                                                                   adapt_steps,
+                                                                   fast_lr,
+                                                                   adaptation_indices,
+                                                                   evaluation_indices,
+                                                                   device,
+                                                                   amp=amp)
+                meta_valid_error = evaluation_error.sum()
+                meta_valid_accuracy = evaluation_accuracy.sum()
+
+                # Compute meta-testing loss
+                batch = next(test_tasks)
+                evaluation_error, evaluation_accuracy = fast_adapt(batch,
+                                                                   head_params,
+                                                                   head,
+                                                                   embed_tasks,
+                                                                   loss,
+                                                                   reg_lambda,
+                                                                   adapt_steps,
+                                                                   fast_lr,
+                                                                   adaptation_indices,
+                                                                   evaluation_indices,
+                                                                   device,
+                                                                   amp=amp)
+                meta_test_error = evaluation_error.sum()
+                meta_test_accuracy = evaluation_accuracy.sum()
+
+            meta_valid_error, meta_valid_accuracy, meta_test_error, meta_test_accuracy = all_reduce_sum(
+                [meta_valid_error, meta_valid_accuracy, meta_test_error, meta_test_accuracy])
+
+        # A single device-to-host copy for all the metrics of the iteration
+        metrics = torch.stack([meta_train_error, meta_train_accuracy,
+                               meta_valid_error, meta_valid_accuracy,
+                               meta_test_error, meta_test_accuracy]) / meta_bsz
+        train_error, train_acc, valid_error, valid_acc, test_error, test_acc = metrics.tolist()
+        training_accuracy[iteration] = train_acc
+        test_accuracy[iteration] = test_acc
 
         # Print some metrics
-        print('\n')
-        print('Iteration', iteration)
-        print('Meta Train Error', meta_train_error / meta_bsz)
-        print('Meta Train Accuracy', meta_train_accuracy / meta_bsz)
-        print('Meta Valid Error', meta_valid_error / meta_bsz)
-        print('Meta Valid Accuracy', meta_valid_accuracy / meta_bsz)
-        print('Meta Test Error', meta_test_error / meta_bsz)
-        print('Meta Test Accuracy', meta_test_accuracy / meta_bsz)
-
-        # Average the accumulated gradients and optimize
-        for p in all_parameters:
-            p.grad.data.mul_(1.0 / meta_bsz)
-            
+        if rank == 0:
+            print('\n')
+            print('Iteration', iteration)
+            print('Meta Train Error', train_error)
+            print('Meta Train Accuracy', train_acc)
+            print('Meta Valid Error', valid_error)
+            print('Meta Valid Accuracy', valid_acc)
+            print('Meta Test Error', test_error)
+            print('Meta Test Accuracy', test_acc)
+
         # print('head')
         # for p in list(head.parameters()):
         #     print(torch.max(torch.abs(p.grad.data)))
@@ -264,7 +444,8 @@ def main(
         optimizer.step()
         end_time = time.time()
         running_time[iteration] = end_time - start_time
-        print('time per iteration', end_time - start_time)
+        if rank == 0:
+            print('time per iteration', end_time - start_time)
         
     
     return training_accuracy.numpy(),test_accuracy.numpy(), running_time
@@ -300,14 +481,13 @@ if __name__ == '__main__':
     
     pstr = '_lr_' + str(lr) + '_fastlr_' + str(fastlr) + '_steps_' + str(stp)
     
-    with open('exp_data/train_accuracy' + pstr, 'wb') as f:
-        pickle.dump(train_accuracy, f)
+    # Only the first process of a torchrun launch saves the results
+    if int(os.environ.get('RANK', 0)) == 0:
+        with open('exp_data/train_accuracy' + pstr, 'wb') as f:
+            pickle.dump(train_accuracy, f)
         
-    with open('exp_data/test_accuracy' + pstr, 'wb') as f:
-        pickle.dump(test_accuracy, f)
+        with open('exp_data/test_accuracy' + pstr, 'wb') as f:
+            pickle.dump(test_accuracy, f)
         
-    with open('exp_data/run_time' + pstr, 'wb') as f:
-        pickle.dump(run_time, f)
-        
-    
-    
\ No newline at end of file
+        with open('exp_data/run_time' + pstr, 'wb') as f:
+            pickle.dump(run_time, f)
@@ -35,8 +35,7 @@ class Lambda(nn.Module):
 
 
 def accuracy(predictions, targets):
-    predictions = predictions.argmax(dim=1).view(targets.shape)
-    return (predictions == targets).sum().float() / targets.size(0)
+    return (predictions.argmax(dim=1) == targets).float().mean()
 
 
 def fast_adapt(batch,
@@ -65,9 +64,7 @@ def fast_adapt(batch,
     evaluation_data, evaluation_labels = data[evaluation_indices], labels[evaluation_indices]
 
     for step in range(adaptation_steps):
-        l2_reg = 0
-        for p in learner.parameters():
-            l2_reg += p.norm(2)
+        l2_reg = sum((p * p).sum() for p in learner.parameters())
         train_error = loss(learner(adaptation_data), adaptation_labels) + reg_lambda*l2_reg 
         learner.adapt(train_error)
 
@@ -170,7 +167,7 @@ def main(
     start_time = time.time()
 
     for iteration in range(iters):
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         meta_train_error = 0.0
         meta_train_accuracy = 0.0
         meta_valid_error = 0.0
@@ -239,8 +236,8 @@ def main(
         print('Meta Test Accuracy', meta_test_accuracy / meta_bsz)
 
         # Average the accumulated gradients and optimize
-        for p in all_parameters:
-            p.grad.data.mul_(1.0 / meta_bsz)
+        grads = [p.grad for p in all_parameters if p.grad is not None]
+        torch._foreach_mul_(grads, 1.0 / meta_bsz)
             
         # print('head')
         # for p in list(head.parameters()):
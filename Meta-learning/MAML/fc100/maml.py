@@ -1,12 +1,15 @@
 
 #!/usr/bin/env python3
 
+import os
 import random
 
 import numpy as np
 import torch
+import torch.distributed as dist
 from torch import nn
 from torch import optim
+from torch.func import functional_call, grad, vmap, replace_all_batch_norm_modules_
 import torchvision as tv
 
 import learn2learn as l2l
@@ -24,54 +27,137 @@ class Lambda(nn.Module):
         return self.fn(x)
 
 def accuracy(predictions, targets):
-    predictions = predictions.argmax(dim=1).view(targets.shape)
-    return (predictions == targets).sum().float() / targets.size(0)
+    return (predictions.argmax(dim=1) == targets).float().mean()
 
 
-def fast_adapt(batch, learner, loss, adaptation_steps, shots, ways, device):
-    data, labels = batch
-    data, labels = data.to(device), labels.to(device)
-
-    # Separate data into adaptation/evalutation sets
-    adaptation_indices = np.zeros(data.size(0), dtype=bool)
-    adaptation_indices[np.arange(shots*ways) * 2] = True
-    evaluation_indices = torch.from_numpy(~adaptation_indices)
-    adaptation_indices = torch.from_numpy(adaptation_indices)
-    adaptation_data, adaptation_labels = data[adaptation_indices], labels[adaptation_indices]
-    evaluation_data, evaluation_labels = data[evaluation_indices], labels[evaluation_indices]
+def inner_loop(params,
+               buffers,
+               adaptation_data,
+               adaptation_labels,
+               evaluation_data,
+               evaluation_labels,
+               model,
+               loss,
+               adaptation_steps,
+               fast_lr):
+    # Adapts the model to a single task; vmapped over the meta-batch in fast_adapt.
+    def train_loss(params):
+        predictions = functional_call(model, (params, buffers), (adaptation_data,))
+        return loss(predictions, adaptation_labels)
 
     # Adapt the model
     for step in range(adaptation_steps):
-        train_error = loss(learner(adaptation_data), adaptation_labels)
-        train_error /= len(adaptation_data)
-        learner.adapt(train_error)
+        grads = grad(train_loss)(params)
+        params = {name: p - fast_lr * grads[name] for name, p in params.items()}
 
     # Evaluate the adapted model
-    predictions = learner(evaluation_data)
+    predictions = functional_call(model, (params, buffers), (evaluation_data,))
     valid_error = loss(predictions, evaluation_labels)
-    valid_error /= len(evaluation_data)
     valid_accuracy = accuracy(predictions, evaluation_labels)
     return valid_error, valid_accuracy
 
 
+def fast_adapt(batch, params, buffers, model, loss, adaptation_steps, fast_lr, adaptation_indices, evaluation_indices, device, amp=False):
+    # batch holds a stack of tasks: [meta_batch_size, 2*shots*ways, ...]
+    data, labels = batch
+    data, labels = data.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+
+    # With amp, adapt in bfloat16 on GPU: no loss scaling is needed and parameters stay in float32
+    with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=amp and device.type == 'cuda'):
+        # Separate data into adaptation/evalutation sets, laid out for the convolutions
+        adaptation_data = channels_last(data.index_select(1, adaptation_indices))
+        evaluation_data = channels_last(data.index_select(1, evaluation_indices))
+        adaptation_labels = labels.index_select(1, adaptation_indices)
+        evaluation_labels = labels.index_select(1, evaluation_indices)
+
+        # Returns the per-task evaluation error and accuracy
+        return vmap(inner_loop, in_dims=(None, None, 0, 0, 0, 0))(params,
+                                                                  buffers,
+                                                                  adaptation_data,
+                                                                  adaptation_labels,
+                                                                  evaluation_data,
+                                                                  evaluation_labels,
+                                                                  model=model,
+                                                                  loss=loss,
+                                                                  adaptation_steps=adaptation_steps,
+                                                                  fast_lr=fast_lr)
+
+
+def task_loader(tasks, num_tasks, num_workers, device, seed):
+    # Returns an endless iterator over meta-batches of num_tasks randomly drawn tasks,
+    # which background workers sample, stack and pin.
+    # TaskDataset draws a task description the first time an index is requested. Draw
+    # them all here, so that every worker shares the same fixed pool of len(tasks) tasks
+    # instead of filling its own differently seeded copy.
+    for i in range(len(tasks)):
+        if i not in tasks.sampled_descriptions:
+            tasks.sampled_descriptions[i] = tasks.sample_task_description()
+    loader = torch.utils.data.DataLoader(tasks,
+                                         batch_size=num_tasks,
+                                         shuffle=True,
+                                         drop_last=True,
+                                         generator=torch.Generator().manual_seed(seed),
+                                         num_workers=num_workers,
+                                         pin_memory=device.type == 'cuda',
+                                         persistent_workers=num_workers > 0,
+                                         prefetch_factor=2 if num_workers > 0 else None)
+
+    # The workers start here, not at the first next(), so that setup is not timed
+    def endless(iterator):
+        while True:
+            yield from iterator
+            iterator = iter(loader)
+    return endless(iter(loader))
+
+
+def channels_last(data):
+    # Lays out a stack of tasks [meta_batch, samples, C, H, W] so that the batch of
+    # images seen by the vmapped convolutions is channels_last (NHWC) for cuDNN
+    return data.flatten(0, 1).contiguous(memory_format=torch.channels_last).view(data.shape)
+
+
+def all_reduce_sum(values):
+    # Sums a list of 0-dim tensors over the processes of a torchrun launch
+    if not dist.is_initialized():
+        return values
+    values = torch.stack(values)
+    dist.all_reduce(values)
+    return values.unbind()
+
+
 def main(
         ways=5,
         shots=5,
         meta_lr=0.003,
-        fast_lr=0.5,
+        fast_lr=0.02,
         meta_batch_size=32,
         adaptation_steps=1,
         num_iterations=60000,
         cuda=True,
+        eval_every=20,
+        amp=False,
+        num_workers=4,
         seed=42,
 ):
-    random.seed(seed)
-    np.random.seed(seed)
+    # Under torchrun, every process adapts meta_batch_size // world_size tasks
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    rank = int(os.environ.get('RANK', 0))
+    if meta_batch_size % world_size != 0:
+        raise ValueError('meta_batch_size (%d) must be divisible by the number of processes (%d)'
+                         % (meta_batch_size, world_size))
+    tasks_per_rank = meta_batch_size // world_size
+
+    # Tasks differ across processes, the initial model does not
+    random.seed(seed + rank)
+    np.random.seed(seed + rank)
     torch.manual_seed(seed)
     device = torch.device('cpu')
     if cuda and torch.cuda.device_count():
         torch.cuda.manual_seed(seed)
-        device = torch.device('cuda')
+        device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+        torch.cuda.set_device(device)
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group('nccl' if device.type == 'cuda' else 'gloo')
 
 
     # Create Datasets
@@ -117,14 +203,29 @@ def main(
     test_tasks = l2l.data.TaskDataset(test_dataset,
                                       task_transforms=test_transforms,
                                       num_tasks=600)
+    train_tasks = task_loader(train_tasks, tasks_per_rank, num_workers, device, seed + rank)
+    valid_tasks = task_loader(valid_tasks, tasks_per_rank, num_workers, device, seed + rank)
+    test_tasks = task_loader(test_tasks, tasks_per_rank, num_workers, device, seed + rank)
 
 
     # Create model
     features = l2l.vision.models.ConvBase(output_size=64, channels=3, max_pool=True)
-    model = torch.nn.Sequential(features, Lambda(lambda x: x.view(-1, 256)),torch.nn.Linear(256, ways))
-    model.to(device)
-    maml = l2l.algorithms.MAML(model, lr=fast_lr, first_order=False)
-    opt = optim.Adam(maml.parameters(), meta_lr)
+    model = torch.nn.Sequential(features, Lambda(lambda x: x.reshape(-1, 256)),torch.nn.Linear(256, ways))
+    # Running statistics are never used and cannot be updated under vmap
+    replace_all_batch_norm_modules_(model)
+    model.to(device, memory_format=torch.channels_last)
+    params = dict(model.named_parameters())
+    buffers = dict(model.named_buffers())
+
+    # Even samples of each task are used for adaptation, odd ones for evaluation
+    adaptation_indices = torch.arange(0, 2*shots*ways, 2, device=device)
+    evaluation_indices = torch.arange(1, 2*shots*ways, 2, device=device)
+
+    opt = optim.Adam(model.parameters(), meta_lr)
+    if world_size > 1:
+        # cherry averages the gradients over processes before each step
+        import cherry
+        opt = cherry.optim.Distributed(model.parameters(), opt=opt, sync=1)
     loss = nn.CrossEntropyLoss(reduction='mean')
     
     training_accuracy =  torch.ones(num_iterations)
@@ -133,76 +234,97 @@ def main(
     import time
     start_time = time.time()
 
+    # Validation and test metrics are only recomputed every eval_every iterations,
+    # all metrics stay on the device until they are printed
+    meta_valid_error = torch.zeros((), device=device)
+    meta_valid_accuracy = torch.zeros((), device=device)
+    meta_test_error = torch.zeros((), device=device)
+    meta_test_accuracy = torch.zeros((), device=device)
+
     for iteration in range(num_iterations):
-        opt.zero_grad()
-        meta_train_error = 0.0
-        meta_train_accuracy = 0.0
-        meta_valid_error = 0.0
-        meta_valid_accuracy = 0.0
-        meta_test_error = 0.0
-        meta_test_accuracy = 0.0
-        for task in range(meta_batch_size):
-            # Compute meta-training loss
-            learner = maml.clone()
-            batch = train_tasks.sample()
-            evaluation_error, evaluation_accuracy = fast_adapt(batch,
-                                                               learner,
-                                                               loss,
-                                                               adaptation_steps,
-                                                               shots,
-                                                               ways,
-                                                               device)
-            evaluation_error.backward()
-            meta_train_error += evaluation_error.item()
-            meta_train_accuracy += evaluation_accuracy.item()
-
-            # Compute meta-validation loss
-            learner = maml.clone()
-            batch = valid_tasks.sample()
-            evaluation_error, evaluation_accuracy = fast_adapt(batch,
-                                                               learner,
-                                                               loss,
-                                                               adaptation_steps,
-                                                               shots,
-                                                               ways,
-                                                               device)
-            meta_valid_error += evaluation_error.item()
-            meta_valid_accuracy += evaluation_accuracy.item()
-            
-            # Compute meta-test loss
-            learner = maml.clone()
-            batch = test_tasks.sample()
-            evaluation_error, evaluation_accuracy = fast_adapt(batch,
-                                                               learner,
-                                                               loss,
-                                                               adaptation_steps,
-                                                               shots,
-                                                               ways,
-                                                               device)
-            meta_test_error += evaluation_error.item()
-            meta_test_accuracy += evaluation_accuracy.item()
-        
-        training_accuracy[iteration] = meta_train_accuracy / meta_batch_size
-        test_accuracy[iteration] = meta_test_accuracy / meta_batch_size
-        
+        opt.zero_grad(set_to_none=True)
+        # Compute meta-training loss
+        batch = next(train_tasks)
+        evaluation_error, evaluation_accuracy = fast_adapt(batch,
+                                                           params,
+                                                           buffers,
+                                                           model,
+                                                           loss,
+                                                           adaptation_steps,
+                                                           fast_lr,
+                                                           adaptation_indices,
+                                                           evaluation_indices,
+                                                           device,
+                                                           amp=amp)
+        # A single backward of the averaged loss covers the whole meta-batch
+        evaluation_error.mean().backward()
+        meta_train_error = evaluation_error.detach().sum()
+        meta_train_accuracy = evaluation_accuracy.sum()
+        meta_train_error, meta_train_accuracy = all_reduce_sum([meta_train_error, meta_train_accuracy])
+
+        if iteration % eval_every == 0:
+            with torch.no_grad():
+                # Compute meta-validation loss
+                batch = next(valid_tasks)
+                evaluation_error, evaluation_accuracy = fast_adapt(batch,
+                                                                   params,
+                                                                   buffers,
+                                                                   model,
+                                                                   loss,
+                                                                   adaptation_steps,
+                                                                   fast_lr,
+                                                                   adaptation_indices,
+                                                                   evaluation_indices,
+                                                                   device,
+                                                                   amp=amp)
+                meta_valid_error = evaluation_error.sum()
+                meta_valid_accuracy = evaluation_accuracy.sum()
+
+                # Compute meta-test loss
+                batch = next(test_tasks)
+                evaluation_error, evaluation_accuracy = fast_adapt(batch,
+                                                                   params,
+                                                                   buffers,
+                                                                   model,
+                                                                   loss,
+                                                                   adaptation_steps,
+                                                                   fast_lr,
+                                                                   adaptation_indices,
+                                                                   evaluation_indices,
+                                                                   device,
+                                                                   amp=amp)
+                meta_test_error = evaluation_error.sum()
+                meta_test_accuracy = evaluation_accuracy.sum()
+
+            meta_valid_error, meta_valid_accuracy, meta_test_error, meta_test_accuracy = all_reduce_sum(
+                [meta_valid_error, meta_valid_accuracy, meta_test_error, meta_test_accuracy])
+
+        # A single device-to-host copy for all the metrics of the iteration
+        metrics = torch.stack([meta_train_error, meta_train_accuracy,
+                               meta_valid_error, meta_valid_accuracy,
+                               meta_test_error, meta_test_accuracy]) / meta_batch_size
+        train_error, train_acc, valid_error, valid_acc, test_error, test_acc = metrics.tolist()
+        training_accuracy[iteration] = train_acc
+        test_accuracy[iteration] = test_acc
+
         # Print some metrics
-        print('\n')
-        print('Iteration', iteration)
-        print('Meta Train Error', meta_train_error / meta_batch_size)
-        print('Meta Train Accuracy', meta_train_accuracy / meta_batch_size)
-        print('Meta Valid Error', meta_valid_error / meta_batch_size)
-        print('Meta Valid Accuracy', meta_valid_accuracy / meta_batch_size)
-        print('Meta Test Error', meta_test_error / meta_batch_size)
-        print('Meta Test Accuracy', meta_test_accuracy / meta_batch_size)
-
-        # Average the accumulated gradients and optimize
-        for p in maml.parameters():
-            p.grad.data.mul_(1.0 / meta_batch_size)
+        if rank == 0:
+            print('\n')
+            print('Iteration', iteration)
+            print('Meta Train Error', train_error)
+            print('Meta Train Accuracy', train_acc)
+            print('Meta Valid Error', valid_error)
+            print('Meta Valid Accuracy', valid_acc)
+            print('Meta Test Error', test_error)
+            print('Meta Test Accuracy', test_acc)
+
+        # Optimize with the meta-batch averaged gradients
         opt.step()
         
         end_time = time.time()
         running_time[iteration] = end_time - start_time
-        print('total running time', end_time - start_time)
+        if rank == 0:
+            print('total running time', end_time - start_time)
 
     # meta_test_error = 0.0
     # meta_test_accuracy = 0.0
@@ -232,7 +354,7 @@ if __name__ == '__main__':
     
     seeds = [42,52,62,72,82]
     lr=0.001
-    fastlr=0.5  # before: fastlr=0.5 & step=3 
+    fastlr=0.02  # was 0.5 while the losses were also divided by the 25 samples
     stp=3
     
     for seed in seeds: 
@@ -253,14 +375,13 @@ if __name__ == '__main__':
     
     pstr = '_lr_' + str(lr) + '_fastlr_' + str(fastlr) + '_steps_' + str(stp)
     
-    with open('exp_data/train_accuracy' + pstr, 'wb') as f:
-        pickle.dump(train_accuracy, f)
-        
-    with open('exp_data/test_accuracy' + pstr, 'wb') as f:
-        pickle.dump(test_accuracy, f)
+    # Only the first process of a torchrun launch saves the results
+    if int(os.environ.get('RANK', 0)) == 0:
+        with open('exp_data/train_accuracy' + pstr, 'wb') as f:
+            pickle.dump(train_accuracy, f)
         
-    with open('exp_data/run_time' + pstr, 'wb') as f:
-        pickle.dump(run_time, f)
-
+        with open('exp_data/test_accuracy' + pstr, 'wb') as f:
+            pickle.dump(test_accuracy, f)
         
-   
+        with open('exp_data/run_time' + pstr, 'wb') as f:
+            pickle.dump(run_time, f)
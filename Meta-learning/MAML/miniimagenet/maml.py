@@ -13,8 +13,7 @@ from learn2learn.data.transforms import NWays, KShots, LoadData, RemapLabels, Co
 import pickle
 
 def accuracy(predictions, targets):
-    predictions = predictions.argmax(dim=1).view(targets.shape)
-    return (predictions == targets).sum().float() / targets.size(0)
+    return (predictions.argmax(dim=1) == targets).float().mean()
 
 
 def fast_adapt(batch, learner, loss, adaptation_steps, shots, ways, device):
@@ -32,13 +31,11 @@ def fast_adapt(batch, learner, loss, adaptation_steps, shots, ways, device):
     # Adapt the model
     for step in range(adaptation_steps):
         train_error = loss(learner(adaptation_data), adaptation_labels)
-        train_error /= len(adaptation_data)
         learner.adapt(train_error)
 
     # Evaluate the adapted model
     predictions = learner(evaluation_data)
     valid_error = loss(predictions, evaluation_labels)
-    valid_error /= len(evaluation_data)
     valid_accuracy = accuracy(predictions, evaluation_labels)
     return valid_error, valid_accuracy
 
@@ -47,7 +44,7 @@ def main(
         ways=5,
         shots=5,
         meta_lr=0.003,
-        fast_lr=0.5,
+        fast_lr=0.02,
         meta_batch_size=32,
         adaptation_steps=1,
         num_iterations=60000,
@@ -117,7 +114,7 @@ def main(
     start_time = time.time()
 
     for iteration in range(num_iterations):
-        opt.zero_grad()
+        opt.zero_grad(set_to_none=True)
         meta_train_error = 0.0
         meta_train_accuracy = 0.0
         meta_valid_error = 0.0
@@ -179,8 +176,8 @@ def main(
         print('Meta Test Accuracy', meta_test_accuracy / meta_batch_size)
 
         # Average the accumulated gradients and optimize
-        for p in maml.parameters():
-            p.grad.data.mul_(1.0 / meta_batch_size)
+        grads = [p.grad for p in maml.parameters() if p.grad is not None]
+        torch._foreach_mul_(grads, 1.0 / meta_batch_size)
         opt.step()
         
         end_time = time.time()
@@ -215,7 +212,7 @@ if __name__ == '__main__':
     
     seeds = [42,52,62,72,82]
     lr=0.003
-    fastlr=0.01  # before: fastlr=0.5 & step=3 
+    fastlr=0.0004  # was 0.01 while the losses were also divided by the 25 samples
     stp=5
     
     for seed in seeds: 